@@ -1,19 +1,28 @@
+import time
+from utils import is_readonly, file_exists, BootTimer
+
+# Started before the display and network imports so the boot log covers them
+boot_timer = BootTimer()
+
+from recovery import RecoveryState
+
+# Arms reload on crash and tells whether this run follows a reload or watchdog reset
+recovery = RecoveryState(debug=True)
+
 import displayio
 import board
 import busio
 from digitalio import DigitalInOut, Direction, Pull
 from adafruit_ssd1351 import SSD1351
-import wifi
-import time
 
 import supervisor
 import json
 import os
+from microcontroller import watchdog
+from watchdog import WatchDogMode
 
 from graphics import Graphics
-from utils import is_readonly, file_exists
 from wifimanager import WifiManager
-from supabase import createClient
 
 # Define pins for buttons and display
 BUTTON_PIN = board.GP42
@@ -44,17 +53,90 @@ button = DigitalInOut(BUTTON_PIN)
 button.direction = Direction.INPUT
 button.pull = Pull.UP
 
-graphics = Graphics(display)
+# Cached note, a bitmap, an animated GIF or a text note depending on what was uploaded
+IMAGE_FILE = "/display.bmp"
+ANIMATION_FILE = "/display.gif"
+TEXT_FILE = "/display.json"
+DOWNLOAD_FILE = "/download.tmp"
+# How images that don't match the display are shown: fit, fill or center
+IMAGE_FIT = os.getenv("IMAGE_FIT") or "fit"
+# Text notes use one of the bundled fonts, picked by file name in the note
+TEXT_FONT = "fonts/vt323-12.bdf"
+ICON_FONT = "fonts/forkawesome-12.pcf"
+
+# Animation frames are only cached once the network stack is up, see the main loop
+graphics = Graphics(display, cache_animations=False)
+boot_timer.mark("display ready")
+
+# Fixed screens, rendered once and then shown with a single bitmap swap
+graphics.add_screen("splash", [
+    {"text": "Box", "font": "fonts/hang-the-dj-12.bdf", "position": (display.width / 2, display.height / 2), "scale": 3},
+])
+graphics.add_screen("no_connection", [
+    {"text": "\uf00d", "font": "fonts/forkawesome-12.pcf", "position": (display.width / 2, (display.height / 2) - 15), "scale": 3},
+    {"text": "No connection!", "font": "fonts/hang-the-dj-12.bdf", "position": (display.width / 2, display.height - 15)},
+])
+graphics.add_screen("new_note", [
+    # Heart icon
+    {"text": "\uf004", "font": "fonts/forkawesome-12.pcf", "position": (display.width / 2, (display.height / 2) - 15), "scale": 3},
+    {"text": "New Note!", "font": "fonts/hang-the-dj-12.bdf", "position": (display.width / 2, display.height - 15)},
+])
+
+def cached_image_file():
+    for file in (ANIMATION_FILE, IMAGE_FILE, TEXT_FILE):
+        if file_exists(file):
+            return file
+    return None
+
+def show_text_note(file):
+    '''Render a text note, e.g.:
+        {"text": "love you", "color": "#FF00FF", "background": "#000000", "font": "vt323-12.bdf", "icon": "\\uf004"}
+    '''
+    with open(file, "r") as f:
+        # json doesn't accept a UTF-8 BOM
+        note = json.loads(f.read().lstrip("\ufeff"))
+
+    # Only fonts bundled on the device, anything else falls back to the default
+    font = TEXT_FONT
+    if note.get("font"):
+        requested = "fonts/" + note["font"].split("/")[-1]
+        if file_exists(requested):
+            font = requested
+
+    graphics.show_text_note(
+        str(note.get("text", "")),
+        font,
+        color=Graphics.html_color_convert(note.get("color", 0xFF00FF)),
+        background=Graphics.html_color_convert(note.get("background", 0x000000)),
+        icon=note.get("icon"),
+        icon_font=ICON_FONT,
+    )
 
-graphics.add_text(
-    (display.width / 2, display.height / 2),
-    "fonts/hang-the-dj-12.bdf",
-    0xFF00FF,
-    line_spacing=1,
-    text_scale=3,
-    text_anchor_point=(0.5, 0.5),
-    text="Box",
-)
+def show_note(file):
+    if file == TEXT_FILE:
+        show_text_note(file)
+    else:
+        graphics.set_background(file, fit=IMAGE_FIT)
+        graphics.remove_all_text()
+
+def show_cached_image() -> bool:
+    file = cached_image_file()
+    if file is None:
+        return False
+    try:
+        show_note(file)
+    except Exception as e:
+        print(f"Failed to show the cached note: {e}")
+        return False
+    return True
+
+# Put the last note on screen before anything touches the network
+has_cached_image = show_cached_image()
+if has_cached_image:
+    boot_timer.mark("cached image shown")
+else:
+    graphics.show_screen("splash")
+    boot_timer.mark("splash shown")
 
 # When fs is mounted as read-only
 if is_readonly():
@@ -74,137 +156,305 @@ opened = button.value
 
 wifimanager = WifiManager(graphics, debug=True)
 
-# Try to establish connection
-if wifimanager.get_connection():
-    # Add connected network text 
-    graphics.add_text(
-        (display.width / 2, display.height - 10),
-        "fonts/vt323-12.bdf",
-        0xFF00FF,
-        line_spacing=1,
-        text_scale=1,
-        text_anchor_point=(0.5, 0.5),
-        text=wifimanager.current_network().ssid
-    )
-    time.sleep(2)
+# Try to establish connection, behind the cached image if there is one
+if wifimanager.get_connection(recovery.last_network()):
+    boot_timer.mark("connected")
+    if not has_cached_image:
+        # Add connected network text below the splash
+        graphics.add_text(
+            (display.width / 2, display.height - 10),
+            "fonts/vt323-12.bdf",
+            0xFF00FF,
+            line_spacing=1,
+            text_scale=1,
+            text_anchor_point=(0.5, 0.5),
+            text=wifimanager.current_network().ssid
+        )
 else:
     # No connection could be established
-    graphics.remove_all_text()
-    graphics.add_text(
-        (display.width / 2, (display.height / 2) - 15),
-        "fonts/forkawesome-12.pcf",
-        0xFF00FF,
-        line_spacing=1,
-        text_scale=3,
-        text_anchor_point=(0.5, 0.5),
-        text="\uf00d"
-    )
-    graphics.add_text(
-        (display.width / 2, display.height - 15),
-        "fonts/hang-the-dj-12.bdf",
-        0xFF00FF,
-        text_anchor_point=(0.5, 0.5),
-        text="No connection!"
-    )
-    time.sleep(5)
+    boot_timer.mark("no known network")
+    graphics.show_screen("no_connection")
 
     # Start wifi portal to establish new connection
     wifimanager.start_server()
+    boot_timer.mark("connected via portal")
 
-# If a recent file exists, display it
-if file_exists("/display.bmp"):
-    graphics.remove_all_text()
-    graphics.set_background("/display.bmp")
+    # Go back to the last note, if there is one
+    show_cached_image()
+
+# Remembered in NVM, so a restart can reconnect without scanning
+network = wifimanager.current_network()
+if network is not None:
+    recovery.set_network(network.ssid, network.channel)
+
+# Imported only now, so loading the TLS stack doesn't delay the cached image
+from supabase import createClient, is_compressed, CAN_INFLATE
+from poller import check_for_note
+from telemetry import Telemetry
+from mqttnotifier import MqttNotifier
+from lanpush import LanPush
 
 # Connect to supabase
 supabase = createClient(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_ANON_KEY"))
+boot_timer.mark("supabase client ready")
+
+# Render the status screens now, so they need no fonts or memory when a note arrives.
+# A warm restart gets to its first poll first and renders them when needed.
+if not recovery.warm_start:
+    graphics.render_screens()
+    boot_timer.mark("screens rendered")
+
+# Read receipts and poll statistics, disabled unless a table is configured
+telemetry = Telemetry(
+    os.getenv("SUPABASE_TELEMETRY_TABLE"),
+    device_id=os.getenv("DEVICE_ID"),
+    flush_interval=os.getenv("TELEMETRY_FLUSH_INTERVAL") or 300,
+    debug=True,
+)
+
+# Optional push channel, polling stays as the fallback while it's disconnected
+notifier = MqttNotifier(
+    os.getenv("MQTT_BROKER"),
+    os.getenv("MQTT_TOPIC"),
+    port=os.getenv("MQTT_PORT") or 1883,
+    username=os.getenv("MQTT_USERNAME"),
+    password=os.getenv("MQTT_PASSWORD"),
+    debug=True,
+)
+
+if recovery.warm_start:
+    telemetry.record("restart", reason=str(recovery.reset_reason), crashes=recovery.data["crashes"])
+
+# Optional upload endpoint for phones on the same network
+lanpush = LanPush(
+    os.getenv("LAN_PUSH_TOKEN"),
+    DOWNLOAD_FILE,
+    hostname=os.getenv("AP_MDNS_HOSTNAME") or "box",
+    debug=True,
+)
+try:
+    lanpush.start()
+except Exception as e:
+    print(f"Failed to start LAN push: {e}")
+
+# Seconds between polls, and between the safety polls while MQTT is connected
+POLL_INTERVAL = 8
+MQTT_POLL_INTERVAL = 300
+# Failed polls back off up to this many seconds, and restart code.py every few failures
+MAX_POLL_BACKOFF = 300
+MAX_POLL_FAILURES = 10
+# Resets the board if the main loop stops running for this many seconds
+WATCHDOG_TIMEOUT = 60
 
 # Load config
-config = { "last-modified": None }
+# The etag and the content hash of the cached image decide whether a poll found a new note.
+# path is the object an MQTT announcement switched to, saved once a poll found it, and
+# configured-path the setting it replaced.
+config = { "last-modified": None, "etag": None, "hash": None, "path": None, "configured-path": None }
 try:
     with open("config.json", "r") as file:
-        config = json.load(file)
+        config.update(json.load(file))
 except:
     print("Config file not found / is corrupted. A new one will be created upon saving.")
 
 next_event_time = time.monotonic()
+first_poll = True
+# Set when a note arrives while the lid is closed, cleared once it's opened
+note_unseen = False
+# Identifies the note on screen in read receipts, whichever way it arrived
+shown_note = {}
 
 print("Starting main loop...")
 bucket = os.getenv("SUPABASE_BUCKET")
-image_path = os.getenv("SUPABASE_IMAGE_PATH")
+configured_path = os.getenv("SUPABASE_IMAGE_PATH")
+image_path = configured_path
+# Keep following an announced object across reboots, until the setting itself changes
+if config["path"] and config["configured-path"] == configured_path:
+    image_path = config["path"]
+
+def save_config():
+    if is_readonly():
+        return
+    print("Saving new config to fs...")
+    try:
+        with open("config.json", "w") as file:
+            json.dump(config, file)
+    except Exception as e:
+        print(f"Failed to save the config file: {e}")
+
+def can_download(path) -> bool:
+    return CAN_INFLATE or not path or not is_compressed(path)
+
+def check_for_update():
+    global image_path
+
+    if not can_download(image_path):
+        # Warned about once, polling it would only fail and back off
+        return
+    previous = config.copy()
+    # Streamed to a temporary file, so a failed download never replaces the cached note
+    download_file = None if is_readonly() else DOWNLOAD_FILE
+    try:
+        new_note = check_for_note(supabase.storage, bucket, image_path, config, download_file)
+    except Exception as e:
+        if image_path != configured_path and "Object not found" in str(e):
+            print(f"Announced {image_path} doesn't exist, going back to {configured_path}.")
+            image_path = configured_path
+            if config["path"] is not None:
+                config["path"] = None
+                save_config()
+        raise
+
+    # The path exists, so an announced one is followed across reboots from now on
+    followed = None if image_path == configured_path else image_path
+    if config["path"] != followed:
+        config["path"] = followed
+        config["configured-path"] = configured_path
+
+    if not new_note:
+        if config != previous:
+            # Same bytes as the cached image, remember the new etag but skip the redraw
+            print("Image is unchanged.")
+            save_config()
+        return
+
+    install_note("supabase", config["etag"], config["last-modified"])
+
+def install_note(source: str, etag=None, modified=None):
+    '''Show and cache the new note waiting in DOWNLOAD_FILE, whose hash is in config.'''
+    global note_unseen, shown_note
+
+    # A new image is available
+    print("New image available!")
+
+    # Display notification
+    graphics.show_screen("new_note")
+
+    # Save the image to file
+    if not is_readonly():
+        print("Saving new image to fs...")
+        try:
+            with open(DOWNLOAD_FILE, "rb") as file:
+                magic = file.read(16)
+            if magic[:4] == b"GIF8":
+                image_file = ANIMATION_FILE
+            elif magic.lstrip(b"\xef\xbb\xbf").lstrip()[:1] == b"{":
+                # Text editors and phone Shortcuts often add a UTF-8 BOM or a leading newline
+                image_file = TEXT_FILE
+            else:
+                image_file = IMAGE_FILE
+            # Only one cached note at a time
+            for stale_file in (ANIMATION_FILE, IMAGE_FILE, TEXT_FILE):
+                if file_exists(stale_file):
+                    os.remove(stale_file)
+            os.rename(DOWNLOAD_FILE, image_file)
+
+            # Display newly donwloaded note
+            show_note(image_file)
+
+            # Read receipt, the sender is told as soon as the box has the note
+            shown_note = {"hash": config["hash"], "etag": etag, "modified": modified}
+            telemetry.record("displayed", urgent=True, lid_open=opened, source=source, **shown_note)
+            note_unseen = not opened
+        except Exception as e:
+            print(f"Failed to save the image file: {e}")
+
+    # Save the config to file
+    save_config()
+
+    print(config)
+
+if not can_download(image_path):
+    print(f"{image_path} is compressed, but this firmware can't inflate it. Only LAN pushes will be shown.")
+    telemetry.record("config_error", error="compressed path without inflate support", path=image_path)
+
+# Enabled only now, the portal above may legitimately wait for a user much longer
+watchdog.timeout = WATCHDOG_TIMEOUT
+watchdog.mode = WatchDogMode.RESET
 
 while True:
+    watchdog.feed()
+
     # Display logic, turn off when button down (closed)
     if (button.value == False) and (button.value != opened):
         # Turn display OFF
         display_bus.send(0xAE, "")
+        graphics.pause_animation()
         opened = False
     elif (button.value == True) and (button.value != opened):
         # Turn display ON
         display_bus.send(0xAF, "")
+        graphics.resume_animation()
         opened = True
 
+        if note_unseen:
+            note_unseen = False
+            telemetry.record("opened", urgent=True, **shown_note)
+
+    graphics.update_animation()
+
+    pushed = lanpush.poll()
+    if pushed:
+        # Keeping the sender's etag lets the next Supabase poll skip this note
+        if pushed["etag"]:
+            config["etag"] = pushed["etag"]
+        if pushed["hash"] is not None and pushed["hash"] == config["hash"]:
+            print("Pushed image is unchanged.")
+            os.remove(DOWNLOAD_FILE)
+            save_config()
+        else:
+            config["hash"] = pushed["hash"]
+            install_note("lan", pushed["etag"])
+
+    message = notifier.poll()
+    if message:
+        if message["etag"] and message["etag"] == config["etag"]:
+            print("Already showing the announced note.")
+        elif message["path"] and not can_download(message["path"]):
+            print(f"Ignoring announced {message['path']}, this firmware can't inflate compressed notes.")
+        else:
+            # Fetch the announced note right away, the path is saved once the poll finds it
+            if message["path"]:
+                image_path = message["path"]
+            next_event_time = 0
+
     if next_event_time < time.monotonic():
         print("Checking for updates...")
 
-        # Needed to get latest image (avoid stale cache)
-        version = time.monotonic()
-        info = supabase.storage.get_public_object_info(bucket, image_path, params={"version": version})
-
-        if info["last-modified"] != config["last-modified"]:
-            # A new image is available
-            print("New image available!")
-
-            # Update last-modified
-            config["last-modified"] = info["last-modified"]
-            
-            # Display notification
-            graphics.set_background(0x000000)
-            # Heart icon
-            graphics.add_text(
-            (display.width / 2, (display.height / 2) - 15),
-            "fonts/forkawesome-12.pcf",
-            0xFF00FF,
-            line_spacing=1,
-            text_scale=3,
-            text_anchor_point=(0.5, 0.5),
-            text="\uf004",
-            )
-            graphics.add_text(
-            (display.width / 2, display.height - 15),
-            "fonts/hang-the-dj-12.bdf",
-            0xFF00FF,
-            text_anchor_point=(0.5, 0.5),
-            text="New Note!",
-            )
-
-            # Download new image
-            image = supabase.storage.get_public_object(bucket, image_path, params={"version": version})
-
-            # Save the image to file
-            if not is_readonly():
-                print("Saving new image to fs...")
-                try:
-                    with open("/display.bmp", "wb") as file:
-                        file.write(image)
-                    
-                    # Display newly donwloaded image
-                    graphics.remove_all_text()
-                    graphics.set_background("/display.bmp")
-                except Exception as e:
-                    print(f"Failed to save the image file: {e}")
-
-            # Save the config to file
-            if not is_readonly():
-                print("Saving new config to fs...")
-                try:
-                    with open("config.json", "w") as file:
-                        json.dump(config, file)
-                except Exception as e:
-                    print(f"Failed to save the config file: {e}")
-            
-            print(config)
-
-        next_event_time = time.monotonic() + 8
-
- 
\ No newline at end of file
+        poll_interval = MQTT_POLL_INTERVAL if notifier.is_connected() else POLL_INTERVAL
+        poll_start = time.monotonic()
+        try:
+            check_for_update()
+            telemetry.record_poll(time.monotonic() - poll_start)
+            recovery.poll_succeeded()
+
+            # TLS, MQTT and the LAN push server now hold their memory, the rest can cache frames
+            if not graphics.cache_animations:
+                graphics.enable_animation_cache()
+
+            # Piggyback queued events on the poll instead of sending them one by one
+            if telemetry.flush_due():
+                telemetry.flush(supabase)
+        except Exception as e:
+            print(f"Failed to check for updates: {e}")
+            telemetry.record_poll(time.monotonic() - poll_start, failed=True)
+            telemetry.record("poll_error", error=str(e))
+
+            failures = recovery.poll_failed()
+            poll_interval = min(POLL_INTERVAL * 2 ** failures, MAX_POLL_BACKOFF)
+            if failures % MAX_POLL_FAILURES == 0:
+                telemetry.save()
+                recovery.restart(f"{failures} failed polls in a row")
+            elif not wifimanager.is_connected():
+                print("Connection lost, reconnecting...")
+                watchdog.feed()
+                wifimanager.get_connection(recovery.last_network())
+
+        if first_poll:
+            first_poll = False
+            boot_timer.mark("first poll done")
+            boot_timer.report()
+            telemetry.record("boot", seconds=round(boot_timer.elapsed(), 2))
+
+        telemetry.save_if_due()
+        next_event_time = time.monotonic() + poll_interval
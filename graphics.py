@@ -1,23 +1,79 @@
 import gc
+import time
+import struct
 import displayio
 import terminalio
+import bitmaptools
 from adafruit_bitmap_font import bitmap_font
 from adafruit_display_text.bitmap_label import Label
 from adafruit_display_text import wrap_text_to_lines
 
 import adafruit_imageload
 
+try:
+    import gifio
+except ImportError:
+    # Without gifio, adafruit_imageload shows the first frame of a GIF
+    gifio = None
+
 # Adapted from https://github.com/adafruit/Adafruit_CircuitPython_PortalBase
 
+# Largest value count the standby buffers accept (16 bit per pixel), enough for
+# indexed images and the RGB565 values truecolor images are decoded into
+BUFFER_VALUE_COUNT = 65536
+
+# Free memory kept aside when caching decoded animation frames, on top of the
+# standby buffers that aren't allocated yet
+ANIMATION_MEMORY_RESERVE = 64 * 1024
+
+# How images that don't match the display are placed, see set_background
+FIT_MODES = ("fit", "fill", "center")
+
+def _read_bmp_header(filename):
+    # Returns what the windowed decoder needs, or None for anything it can't decode
+    with open(filename, "rb") as file:
+        header = file.read(54)
+    if len(header) < 50 or header[0:2] != b"BM":
+        return None
+    (
+        _, _, data_offset, header_size, width, height, _, bpp, compression, _, _, _, colors
+    ) = struct.unpack_from("<2sI4xIIiiHHIIiiI", header)
+    if bpp not in (1, 4, 8, 24, 32) or compression not in (0, 3) or (compression == 3 and bpp != 32):
+        return None
+    return {
+        "data_offset": data_offset,
+        "header_size": header_size,
+        "width": width,
+        "height": height,
+        "bpp": bpp,
+        "colors": colors,
+    }
+
 class Graphics:
-    def __init__(self, display, default_bg=0x000000, scale=1, debug=False):
+    def __init__(self, display, default_bg=0x000000, scale=1, double_buffer=True, cache_animations=True, debug=False):
 
         self._debug = debug
         self.display = display
 
+        # Background buffers: images matching the display size are decoded into
+        # whichever of the two buffers is not on screen, then swapped in
+        self._double_buffer = double_buffer
+        self._buffers = [None, None]
+        self._front_buffer = None
+        self._bg_sprite = None
+        # Reused for every solid color background
+        self._fill_bitmap = None
+        self._fill_palette = None
+        # Animated GIF background, advanced by update_animation. Decoded frames are only
+        # cached when cache_animations is set, see enable_animation_cache
+        self._animation = None
+        self.cache_animations = cache_animations
+
         # Font Cache
         self._fonts = {}
         self._text = []
+        # Fixed screens, each rendered once into a single bitmap
+        self._screens = {}
 
         if self._debug:
             print("Init display")
@@ -36,18 +92,41 @@ class Graphics:
 
         gc.collect()
 
-    def set_background(self, file_or_color, position=None):
-        while self._bg_group:
-            self._bg_group.pop()
+    def set_background(self, file_or_color, position=None, fit=None):
+        '''Show a color or an image file as background.
+
+        Images that don't match the display size can be placed with fit: "fit" scales them
+        to fit inside the display, "fill" scales and crops them to cover it, and "center"
+        crops or pads them without scaling. Bitmaps larger than the result are scaled while
+        decoding, so they're never held in memory at full size.
+        '''
+        if fit is not None and fit not in FIT_MODES:
+            raise ValueError("fit must be one of " + ", ".join(FIT_MODES))
 
         if not position:
             position = (0, 0)  # default in top corner
 
         if not file_or_color:
-            return  # we're done, no background desired
-        if isinstance(file_or_color, str):  # its a filenme:
-            bitmap, palette = adafruit_imageload.load(file_or_color, bitmap=displayio.Bitmap, palette=displayio.Palette)
-            self._bg_sprite = displayio.TileGrid(
+            # we're done, no background desired
+            while self._bg_group:
+                self._bg_group.pop()
+            self._bg_sprite = None
+            self._front_buffer = None
+            self.stop_animation()
+            gc.collect()
+            return
+
+        # Build the new TileGrid while the old one stays on screen
+        buffer_index = None
+        if isinstance(file_or_color, str) and gifio and file_or_color.lower().endswith(".gif"):
+            self._set_animation(file_or_color, position, fit)
+            return
+        elif isinstance(file_or_color, str):  # its a filenme:
+            buffer_index = self._standby_buffer_index()
+            bitmap, palette, position = self._load_image(file_or_color, position, fit, buffer_index)
+            if buffer_index is not None and bitmap is not self._buffers[buffer_index]:
+                buffer_index = None
+            sprite = displayio.TileGrid(
                 bitmap,
                 pixel_shader=palette,
                 x=position[0],
@@ -55,19 +134,371 @@ class Graphics:
             )
         elif isinstance(file_or_color, int):
             # Make a background color fill
-            color_bitmap = displayio.Bitmap(self.display.width, self.display.height, 1)
-            color_palette = displayio.Palette(1)
-            color_palette[0] = file_or_color
-            self._bg_sprite = displayio.TileGrid(
-                color_bitmap,
-                pixel_shader=color_palette,
+            if self._fill_bitmap is None:
+                self._fill_bitmap = displayio.Bitmap(self.display.width, self.display.height, 1)
+                self._fill_palette = displayio.Palette(1)
+            self._fill_palette[0] = file_or_color
+            sprite = displayio.TileGrid(
+                self._fill_bitmap,
+                pixel_shader=self._fill_palette,
                 x=position[0],
                 y=position[1],
             )
         else:
             raise RuntimeError("Unknown type of background")
-        self._bg_group.append(self._bg_sprite)
+
+        self._swap_background(sprite, buffer_index)
+        gc.collect()
+
+    def _swap_background(self, sprite, buffer_index=None):
+        # Swap in one step, so the display never shows an empty background
+        if self._bg_group:
+            self._bg_group[0] = sprite
+            while len(self._bg_group) > 1:
+                self._bg_group.pop()
+        else:
+            self._bg_group.append(sprite)
+        self._bg_sprite = sprite
+        self._front_buffer = buffer_index
+
+        if self._animation is not None and sprite is not self._animation["sprite"]:
+            self.stop_animation()
+
+    def _set_animation(self, filename, position, fit=None):
+        gif = gifio.OnDiskGif(filename)
+        if fit is not None:
+            # Frames aren't scaled, only centered
+            position = ((self.display.width - gif.width) // 2, (self.display.height - gif.height) // 2)
+        frame_size = gif.width * gif.height * 2
+        shader = displayio.ColorConverter(input_colorspace=displayio.Colorspace.RGB565_SWAPPED)
+
+        # Decode every frame once if they all fit, otherwise decode each frame when it's due
+        gc.collect()
+        frames = None
+        if (
+            self.cache_animations
+            and gif.frame_count > 1
+            and gif.frame_count * frame_size <= gc.mem_free() - self._animation_reserve()
+        ):
+            if self._debug:
+                print("Caching", gif.frame_count, "animation frames")
+            frames = []
+            for _ in range(gif.frame_count):
+                delay = gif.next_frame()
+                frame = displayio.Bitmap(gif.width, gif.height, BUFFER_VALUE_COUNT)
+                bitmaptools.blit(frame, gif.bitmap, 0, 0)
+                frames.append((frame, delay))
+            gif.deinit()
+            gif = None
+            bitmap, delay = frames[0]
+        else:
+            if self._debug:
+                print("Streaming animation frames from", filename)
+            delay = gif.next_frame()
+            bitmap = gif.bitmap
+
+        sprite = displayio.TileGrid(bitmap, pixel_shader=shader, x=position[0], y=position[1])
+        animation = {
+            "filename": filename,
+            "position": position,
+            "gif": gif,
+            "frames": frames,
+            "index": 0,
+            "sprite": sprite,
+            "next_frame_time": time.monotonic() + delay,
+            "paused": False,
+        }
+        # The previous animation is released only once it's off screen
+        previous = self._animation
+        self._animation = animation
+        self._swap_background(sprite)
+        if previous is not None:
+            self._release_animation(previous)
+        gc.collect()
+
+    def _animation_reserve(self):
+        reserve = ANIMATION_MEMORY_RESERVE
+        if self._double_buffer:
+            # Keep room for the buffers the next display sized bitmap is decoded into
+            reserve += self._buffers.count(None) * self.display.width * self.display.height * 2
+        return reserve
+
+    def enable_animation_cache(self):
+        '''Allow caching decoded animation frames, and cache the running animation if it fits.
+        Call it once everything else that stays in memory (network, servers) is set up, so the
+        frame cache is sized against what's really left.'''
+        self.cache_animations = True
+        animation = self._animation
+        if animation is None or animation["frames"] is not None:
+            return
+        self._set_animation(animation["filename"], animation["position"])
+        if animation["paused"]:
+            self.pause_animation()
+
+    def update_animation(self):
+        '''Show the next animation frame once it's due. Never blocks, call it from the main loop.'''
+        animation = self._animation
+        if animation is None or animation["paused"]:
+            return
+        now = time.monotonic()
+        if now < animation["next_frame_time"]:
+            return
+
+        if animation["frames"] is not None:
+            animation["index"] = (animation["index"] + 1) % len(animation["frames"])
+            bitmap, delay = animation["frames"][animation["index"]]
+            animation["sprite"].bitmap = bitmap
+        else:
+            # Decodes straight into the bitmap on screen
+            delay = animation["gif"].next_frame()
+        # A late loop iteration drops the lost time instead of rushing the following frames
+        animation["next_frame_time"] = max(animation["next_frame_time"] + delay, now)
+
+    def pause_animation(self):
+        if self._animation is not None:
+            self._animation["paused"] = True
+
+    def resume_animation(self):
+        if self._animation is not None and self._animation["paused"]:
+            self._animation["paused"] = False
+            self._animation["next_frame_time"] = time.monotonic()
+
+    def stop_animation(self):
+        if self._animation is None:
+            return
+        self._release_animation(self._animation)
+        self._animation = None
+        gc.collect()
+
+    @staticmethod
+    def _release_animation(animation):
+        if animation["gif"] is not None:
+            animation["gif"].deinit()
+        animation["frames"] = None
+
+    def _load_image(self, filename, position, fit, buffer_index):
+        info = _read_bmp_header(filename) if fit is not None and filename.lower().endswith(".bmp") else None
+        layout = self._fit_layout(info["width"], abs(info["height"]), fit) if info else None
+        if layout is None or (layout[0] == 1 and layout[1] == (0, 0, info["width"], abs(info["height"]))):
+            # Nothing to scale or crop
+            bitmap, palette = adafruit_imageload.load(
+                filename,
+                bitmap=self._bitmap_factory(buffer_index),
+                palette=displayio.Palette,
+            )
+            return bitmap, palette, layout[3] if layout else position
+
+        scale, crop, size, position = layout
+        if scale > 1:
+            # A smaller source is cheap to load whole, then it's zoomed into the result
+            source, palette = adafruit_imageload.load(filename, bitmap=displayio.Bitmap, palette=displayio.Palette)
+            bitmap = self._bitmap_factory(buffer_index)(size[0], size[1], BUFFER_VALUE_COUNT)
+            bitmap.fill(0)
+            bitmaptools.rotozoom(
+                bitmap,
+                source,
+                ox=size[0] // 2,
+                oy=size[1] // 2,
+                px=crop[0] + crop[2] // 2,
+                py=crop[1] + crop[3] // 2,
+                scale=scale,
+            )
+            return bitmap, palette, position
+
+        bitmap, palette = self._decode_bmp_window(filename, info, crop, size, buffer_index)
+        return bitmap, palette, position
+
+    def _fit_layout(self, width, height, fit):
+        # Returns the scale, the source window (x, y, width, height), the result size and its position
+        if fit == "fit":
+            scale = min(self.display.width / width, self.display.height / height)
+        elif fit == "fill":
+            scale = max(self.display.width / width, self.display.height / height)
+        else:
+            scale = 1
+        size = (
+            min(self.display.width, max(1, round(width * scale))),
+            min(self.display.height, max(1, round(height * scale))),
+        )
+        crop_width = min(width, max(1, round(size[0] / scale)))
+        crop_height = min(height, max(1, round(size[1] / scale)))
+        crop = ((width - crop_width) // 2, (height - crop_height) // 2, crop_width, crop_height)
+        position = ((self.display.width - size[0]) // 2, (self.display.height - size[1]) // 2)
+        return scale, crop, size, position
+
+    def _decode_bmp_window(self, filename, info, crop, size, buffer_index):
+        # Nearest neighbour decode of a window of the file, reading only the rows that are used
+        crop_x, crop_y, crop_width, crop_height = crop
+        width, height = size
+        bpp = info["bpp"]
+        indexed = bpp <= 8
+        bitmap = self._bitmap_factory(buffer_index)(width, height, 1 << bpp if indexed else BUFFER_VALUE_COUNT)
+
+        with open(filename, "rb") as file:
+            if indexed:
+                colors = info["colors"] or 1 << bpp
+                file.seek(14 + info["header_size"])
+                table = file.read(4 * colors)
+                shader = displayio.Palette(colors)
+                for i in range(colors):
+                    shader[i] = table[4 * i + 2] << 16 | table[4 * i + 1] << 8 | table[4 * i]
+            else:
+                # Pixels are stored as RGB565 values
+                shader = displayio.ColorConverter(input_colorspace=displayio.Colorspace.RGB565)
+
+            stride = (bpp * info["width"] + 31) // 32 * 4
+            start_byte = crop_x * bpp // 8
+            row = bytearray(((crop_x + crop_width) * bpp + 7) // 8 - start_byte)
+            # Bit offset in row of the source pixel for each column of the result
+            columns = [(crop_x + x * crop_width // width) * bpp - start_byte * 8 for x in range(width)]
+            mask = (1 << bpp) - 1
+
+            for y in range(height):
+                source_y = crop_y + y * crop_height // height
+                if info["height"] > 0:
+                    # Rows are stored bottom-up
+                    source_y = info["height"] - 1 - source_y
+                file.seek(info["data_offset"] + source_y * stride + start_byte)
+                file.readinto(row)
+                if bpp == 8:
+                    for x, bit in enumerate(columns):
+                        bitmap[x, y] = row[bit >> 3]
+                elif indexed:
+                    for x, bit in enumerate(columns):
+                        bitmap[x, y] = (row[bit >> 3] >> (8 - bpp - (bit & 7))) & mask
+                else:
+                    for x, bit in enumerate(columns):
+                        i = bit >> 3
+                        bitmap[x, y] = (row[i + 2] & 0xF8) << 8 | (row[i + 1] & 0xFC) << 3 | row[i] >> 3
+            gc.collect()
+
+        return bitmap, shader
+
+    def _standby_buffer_index(self):
+        if not self._double_buffer:
+            return None
+        return 1 if self._front_buffer == 0 else 0
+
+    def _bitmap_factory(self, buffer_index):
+        # Passed to adafruit_imageload in place of displayio.Bitmap. Display
+        # sized images land in the standby buffer, anything else is allocated.
+        def factory(width, height, value_count):
+            if (
+                buffer_index is None
+                or width != self.display.width
+                or height != self.display.height
+                or value_count > BUFFER_VALUE_COUNT
+            ):
+                return displayio.Bitmap(width, height, value_count)
+            if self._buffers[buffer_index] is None:
+                if self._debug:
+                    print("Allocating background buffer", buffer_index)
+                self._buffers[buffer_index] = displayio.Bitmap(width, height, BUFFER_VALUE_COUNT)
+            return self._buffers[buffer_index]
+
+        return factory
+
+    def add_screen(self, name, texts, color=0xFF00FF, background=0x000000):
+        '''Define a fixed screen, shown with show_screen. Each entry in texts is a dict with
+        the "text", "font" and "position" and optionally "scale" and "anchor_point" keys.'''
+        self._screens[name] = {
+            "texts": texts,
+            "color": color,
+            "background": background,
+            "sprite": None,
+        }
+
+    def render_screen(self, name):
+        '''Render a screen into one 2 color bitmap, unless that already happened.'''
+        screen = self._screens[name]
+        if screen["sprite"] is not None:
+            return screen["sprite"]
+
+        if self._debug:
+            print("Rendering screen:", name)
+        bitmap = displayio.Bitmap(self.display.width, self.display.height, 2)
+        palette = displayio.Palette(2)
+        palette[0] = screen["background"]
+        palette[1] = screen["color"]
+
+        for text in screen["texts"]:
+            # The label is only used to lay out the glyphs, its bitmap is copied and dropped
+            label = Label(self._fonts[self._load_font(text["font"])], text=text["text"])
+            source = label.bitmap
+            if source is None:
+                continue
+            anchor_point = text.get("anchor_point", (0.5, 0.5))
+            bitmaptools.rotozoom(
+                bitmap,
+                source,
+                ox=int(text["position"][0]),
+                oy=int(text["position"][1]),
+                px=int(source.width * anchor_point[0]),
+                py=int(source.height * anchor_point[1]),
+                scale=text.get("scale", 1),
+                skip_index=0,
+            )
+
+        screen["sprite"] = displayio.TileGrid(bitmap, pixel_shader=palette)
         gc.collect()
+        return screen["sprite"]
+
+    def render_screens(self):
+        '''Render all defined screens ahead of time, so showing them later allocates nothing.'''
+        for name in self._screens:
+            self.render_screen(name)
+
+    def show_screen(self, name):
+        sprite = self.render_screen(name)
+        self.remove_all_qr()
+        self._swap_background(sprite)
+        self.remove_all_text()
+
+    def show_text_note(self, text, font, color=0xFF00FF, background=0x000000, icon=None, icon_font=None, max_scale=3, margin=4):
+        '''Show a note that was sent as text: an optional icon glyph at the top, then the
+        text wrapped and scaled up as far as it fits the rest of the display.'''
+        self.remove_all_qr()
+        self.set_background(background)
+        self.remove_all_text()
+
+        top = margin
+        if icon and icon_font:
+            icon_height = self._fonts[self._load_font(icon_font)].get_bounding_box()[1] * 2
+            self.add_text(
+                (self.display.width / 2, top),
+                icon_font,
+                color,
+                text_scale=2,
+                text_anchor_point=(0.5, 0),
+                text=icon,
+            )
+            top += icon_height + margin
+
+        if not text:
+            return
+
+        # The bounding box fits the widest glyph, so wrapping by it never overflows a line
+        glyph_width, glyph_height = self._fonts[self._load_font(font)].get_bounding_box()[:2]
+        width = self.display.width - 2 * margin
+        height = self.display.height - top - margin
+        for scale in range(max_scale, 0, -1):
+            max_chars = max(1, width // (glyph_width * scale))
+            lines = self.wrap_nicely(text, max_chars)
+            if len(lines) * glyph_height * scale <= height:
+                break
+
+        if self._debug:
+            print(f"Text note fits {max_chars} characters per line at scale {scale}")
+        self.add_text(
+            (self.display.width / 2, top + height / 2),
+            font,
+            color,
+            text_wrap=max_chars,
+            text_scale=scale,
+            line_spacing=1,
+            text_anchor_point=(0.5, 0.5),
+            text=text,
+        )
 
     def add_qrcode(
         self, qrcode, *, qr_size=1, x=0, y=0, qr_color=0x000000, qr_anchor_point=(0.0, 0.0)
@@ -255,4 +686,18 @@ class Graphics:
             color = self.html_color_convert(color)
             self._text[index]["color"] = color
             if self._text[index]["label"] is not None:
-                self._text[index]["label"].color = color
\ No newline at end of file
+                self._text[index]["label"].color = color
+
+    @staticmethod
+    def html_color_convert(color):
+        '''Convert a "#RRGGBB" string, an (r, g, b) tuple or an int to an int color.'''
+        if isinstance(color, int):
+            return color
+        if isinstance(color, str):
+            color = color.lstrip("#")
+            if len(color) != 6:
+                raise ValueError("Color should be in the #RRGGBB format.")
+            return int(color, 16)
+        if isinstance(color, (tuple, list)) and len(color) == 3:
+            return (color[0] << 16) | (color[1] << 8) | color[2]
+        raise ValueError("Unknown type of color")
\ No newline at end of file
@@ -0,0 +1,118 @@
+import wifi
+from poller import content_hash
+from utils import is_readonly
+
+# Largest upload accepted, the body is held in memory before it's written to flash
+MAX_NOTE_SIZE = 64 * 1024
+
+class LanPush:
+    '''Accepts notes uploaded straight from phones on the same network.
+
+    Serves POST /note on the station interface, advertised over mDNS as <hostname>.local.
+    Requests must carry "Authorization: Bearer <token>". The body is the image; an
+    optional "X-Note-ETag" header with the ETag of the same file in Supabase Storage lets
+    the next poll recognize it without downloading it again. Bodies larger than max_size
+    are refused with 413 before they're read.
+
+    The portal dependencies are imported in start, like in WifiManager.start_server.
+    '''
+    def __init__(self, token: str, download_path: str, hostname: str = "box", port: int = 80, max_size: int = MAX_NOTE_SIZE, debug=False):
+        self._debug = debug
+        self.token = token
+        self.download_path = download_path
+        self.hostname = hostname
+        self.port = port
+        self.max_size = max_size
+
+        self._server = None
+        self._mdns_server = None
+        self._received = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token)
+
+    def start(self):
+        if not self.enabled or self._server is not None:
+            return
+
+        import mdns
+        import socketpool
+        from adafruit_httpserver import (
+            Server as HTTPServer,
+            Request as HTTPRequest,
+            JSONResponse,
+            Bearer,
+            check_authentication,
+            Status,
+            BAD_REQUEST_400,
+            UNAUTHORIZED_401,
+            SERVICE_UNAVAILABLE_503,
+        )
+        PAYLOAD_TOO_LARGE_413 = Status(413, "Payload Too Large")
+        max_size = self.max_size
+
+        class CappedServer(HTTPServer):
+            # The server reads the whole body before routing, stop at the headers when it's too large
+            def _receive_body_bytes(self, sock, received_body_bytes, content_length):
+                if content_length > max_size:
+                    return received_body_bytes
+                return super()._receive_body_bytes(sock, received_body_bytes, content_length)
+
+        self._mdns_server = mdns.Server(wifi.radio)
+        self._mdns_server.hostname = self.hostname
+        self._mdns_server.advertise_service(service_type="_http", protocol="_tcp", port=self.port)
+
+        pool = socketpool.SocketPool(wifi.radio)
+        server = CappedServer(pool, debug=self._debug)
+        auths = [Bearer(self.token)]
+
+        @server.route("/note", methods=["POST"])
+        def route_func(request: HTTPRequest):
+            if not check_authentication(request, auths):
+                return JSONResponse(request, {"error": "unauthorized"}, status=UNAUTHORIZED_401)
+            content_length = int(request.headers.get("Content-Length", 0))
+            if content_length > self.max_size:
+                return JSONResponse(request, {"error": "too large", "max_size": self.max_size}, status=PAYLOAD_TOO_LARGE_413)
+            if not content_length:
+                return JSONResponse(request, {"error": "empty note"}, status=BAD_REQUEST_400)
+            if is_readonly() or self._received is not None:
+                return JSONResponse(request, {"error": "busy"}, status=SERVICE_UNAVAILABLE_503)
+
+            body = request.body
+            with open(self.download_path, "wb") as file:
+                file.write(body)
+            self._received = {
+                "hash": content_hash(body),
+                "etag": request.headers.get("X-Note-ETag"),
+                "size": len(body),
+            }
+            self._debug and print(f"Received a {len(body)} byte note over the LAN")
+            return JSONResponse(request, {"status": "received"})
+
+        server.start(str(wifi.radio.ipv4_address), self.port)
+        self._server = server
+        if self._debug:
+            print("LAN push reachable at: http://" + self.hostname + ".local/note")
+
+    def poll(self):
+        '''Serve pending requests without blocking. Returns the note received since the
+        last call, already written to download_path, or None.'''
+        if self._server is None:
+            return None
+        try:
+            self._server.poll()
+        except Exception as e:
+            print(f"LAN push request failed: {e}")
+
+        received = self._received
+        self._received = None
+        return received
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.stop()
+        self._mdns_server.deinit()
+        self._server = None
+        self._mdns_server = None
@@ -0,0 +1,123 @@
+import json
+import time
+import ssl
+import socketpool
+import wifi
+
+# Seconds to wait before reconnecting, doubled after every failed attempt
+MIN_BACKOFF = 2
+MAX_BACKOFF = 300
+# Seconds to wait for the broker's CONNACK and SUBACK, the main loop is blocked meanwhile
+RECV_TIMEOUT = 3
+
+class MqttNotifier:
+    '''Keeps one MQTT connection open and reports new notes published on a topic.
+
+    Messages are JSON objects with the path of the new object in the bucket and its
+    ETag, e.g. {"path": "note.bmp", "etag": "\\"5d41402abc4b2a76\\""}. Publish them
+    retained, so a box that (re)connects picks up the latest note right away.
+    While the notifier is not connected, the caller is expected to fall back to polling.
+    '''
+    def __init__(self, broker: str, topic: str, port: int = 1883, username: str = None, password: str = None, keep_alive: int = 60, debug=False):
+        self._debug = debug
+        self.broker = broker
+        self.topic = topic
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keep_alive = keep_alive
+
+        self._client = None
+        self._connected = False
+        self._backoff = MIN_BACKOFF
+        self._next_attempt = time.monotonic()
+        self._message = None
+
+        if self._debug:
+            print("Init MQTT Notifier")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.broker and self.topic)
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def poll(self):
+        '''Service the connection without blocking for long. Returns the latest
+        message received since the last call, or None.'''
+        if not self.enabled:
+            return None
+
+        if not self._connected:
+            if time.monotonic() < self._next_attempt:
+                return None
+            self._connect()
+            if not self._connected:
+                return None
+
+        try:
+            # Also sends the keepalive ping when it's due
+            self._client.loop(timeout=0.1)
+        except Exception as e:
+            print(f"MQTT connection lost: {e}")
+            self._disconnected()
+
+        message = self._message
+        self._message = None
+        return message
+
+    def _connect(self):
+        try:
+            if self._client is None:
+                import adafruit_minimqtt.adafruit_minimqtt as MQTT
+
+                is_ssl = self.port == 8883
+                self._client = MQTT.MQTT(
+                    broker=self.broker,
+                    port=self.port,
+                    username=self.username,
+                    password=self.password,
+                    is_ssl=is_ssl,
+                    keep_alive=self.keep_alive,
+                    socket_pool=socketpool.SocketPool(wifi.radio),
+                    ssl_context=ssl.create_default_context() if is_ssl else None,
+                    socket_timeout=0.1,
+                    recv_timeout=RECV_TIMEOUT,
+                    # Retries are left to the backoff in poll
+                    connect_retries=1,
+                )
+                self._client.on_message = self._on_message
+                self._client.on_disconnect = self._on_disconnect
+                self._client.connect()
+            else:
+                self._client.reconnect()
+
+            self._client.subscribe(self.topic, qos=1)
+            self._connected = True
+            self._backoff = MIN_BACKOFF
+            self._debug and print(f"Subscribed to {self.topic} on {self.broker}")
+        except ImportError:
+            print("adafruit_minimqtt is not installed. MQTT notifications are disabled.")
+            self.broker = None
+        except Exception as e:
+            print(f"Failed to connect to the MQTT broker: {e}")
+            self._disconnected()
+
+    def _disconnected(self):
+        self._connected = False
+        self._next_attempt = time.monotonic() + self._backoff
+        self._debug and print(f"Reconnecting to the MQTT broker in {self._backoff}s")
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if self._connected:
+            self._disconnected()
+
+    def _on_message(self, client, topic, message):
+        try:
+            data = json.loads(message)
+            self._message = {"path": data.get("path"), "etag": data.get("etag")}
+            self._debug and print(f"MQTT message on {topic}: {self._message}")
+        except Exception as e:
+            print(f"Ignoring malformed MQTT message: {e}")
@@ -0,0 +1,76 @@
+import os
+import time
+import binascii
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+
+# Only depends on the storage client, so the fleet simulator in tools/ runs the same logic on CPython
+
+def content_hash(data):
+    '''SHA-1 of the data as a hex string, or None on builds without hashlib.'''
+    if hashlib is None:
+        return None
+    return binascii.hexlify(hashlib.new("sha1", data).digest()).decode()
+
+class _HashingWriter:
+    '''Hashes everything written to it and passes it on to file, if there is one.'''
+    def __init__(self, file=None):
+        self.file = file
+        self._hash = hashlib.new("sha1") if hashlib is not None else None
+
+    def write(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        if self.file is not None:
+            self.file.write(data)
+        return len(data)
+
+    def hexdigest(self):
+        if self._hash is None:
+            return None
+        return binascii.hexlify(self._hash.digest()).decode()
+
+def check_for_note(storage, bucket: str, path: str, state, download_path: str = None) -> bool:
+    '''Poll once for a new note.
+
+    state holds the "etag", "last-modified" and "hash" of the current note and is
+    updated in place. A changed object is streamed into download_path, or only hashed
+    when there is none. Returns True if it holds a new note; otherwise the download
+    is removed again.
+    '''
+    # Needed to get latest image (avoid stale cache)
+    version = time.monotonic()
+    info = storage.get_public_object_info(bucket, path, params={"version": version})
+
+    # The etag follows the content, last-modified also changes on identical re-uploads
+    etag = info.get("etag")
+    if etag:
+        if etag == state.get("etag"):
+            return False
+    elif info.get("last-modified") == state.get("last-modified"):
+        return False
+
+    print("Image changed, downloading...")
+    file = open(download_path, "wb") if download_path else None
+    try:
+        writer = _HashingWriter(file)
+        storage.download_public_object(bucket, path, writer, params={"version": version})
+    finally:
+        if file is not None:
+            file.close()
+
+    state["last-modified"] = info.get("last-modified")
+    state["etag"] = etag
+
+    # Same bytes as the current note, only the new etag is worth remembering
+    digest = writer.hexdigest()
+    if digest is not None and digest == state.get("hash"):
+        if download_path:
+            os.remove(download_path)
+        return False
+
+    state["hash"] = digest
+    return True
@@ -0,0 +1,86 @@
+import json
+import microcontroller
+import supervisor
+
+# Consecutive crash reloads before giving up and leaving the error on the serial console
+MAX_CRASH_RELOADS = 5
+
+class RecoveryState:
+    '''Small state kept in microcontroller.nvm, so it survives reloads, watchdog resets
+    and power loss without touching the filesystem.
+
+    Example:
+        {"ssid": "my_wifi", "channel": 6, "failures": 0, "crashes": 0, "restarting": false}
+    '''
+    def __init__(self, debug=False):
+        self._debug = debug
+        self.data = {"ssid": None, "channel": 0, "failures": 0, "crashes": 0, "restarting": False}
+        self._saved = None
+        self.load()
+
+        # Any run that didn't start from a reset came from a reload, with the radio still up
+        self.reset_reason = microcontroller.cpu.reset_reason
+        self.warm_start = (
+            supervisor.runtime.run_reason != supervisor.RunReason.STARTUP
+            or self.reset_reason == microcontroller.ResetReason.WATCHDOG
+        )
+        # Only reloads nobody asked for count as crashes, not restart() or a reload from the REPL
+        intentional = self.data["restarting"] or supervisor.runtime.run_reason in (
+            supervisor.RunReason.REPL_RELOAD,
+            supervisor.RunReason.AUTO_RELOAD,
+        )
+        self.data["restarting"] = False
+        if self.warm_start and not intentional:
+            self.data["crashes"] += 1
+            self._debug and print(f"Warm start ({self.reset_reason}), crash count: {self.data['crashes']}")
+
+        # Reload code.py on an uncaught exception, unless it keeps crashing right away
+        supervisor.set_next_code_file(None, reload_on_error=self.data["crashes"] < MAX_CRASH_RELOADS)
+        self.save()
+
+    def load(self):
+        try:
+            length = int.from_bytes(microcontroller.nvm[0:2], "big")
+            if 0 < length < len(microcontroller.nvm) - 2:
+                self.data.update(json.loads(bytes(microcontroller.nvm[2 : 2 + length])))
+            self._saved = json.dumps(self.data)
+        except Exception as e:
+            self._debug and print(f"Recovery state not found / is corrupted: {e}")
+
+    def save(self):
+        # NVM is flash, only write when something changed
+        encoded = json.dumps(self.data)
+        if encoded == self._saved:
+            return
+        raw = encoded.encode()
+        if len(raw) + 2 > len(microcontroller.nvm):
+            print("Recovery state is too large for NVM.")
+            return
+        microcontroller.nvm[0 : 2 + len(raw)] = len(raw).to_bytes(2, "big") + raw
+        self._saved = encoded
+
+    def last_network(self):
+        return self.data["ssid"], self.data["channel"]
+
+    def set_network(self, ssid: str, channel: int):
+        self.data["ssid"] = ssid
+        self.data["channel"] = channel
+        self.save()
+
+    def poll_failed(self) -> int:
+        self.data["failures"] += 1
+        self.save()
+        return self.data["failures"]
+
+    def poll_succeeded(self):
+        # Reaching a successful poll also means this run isn't crash looping
+        self.data["failures"] = 0
+        self.data["crashes"] = 0
+        self.save()
+
+    def restart(self, reason: str):
+        '''Warm restart: reruns code.py without resetting the chip, so WiFi stays connected.'''
+        print(f"Restarting: {reason}")
+        self.data["restarting"] = True
+        self.save()
+        supervisor.reload()
@@ -1,7 +1,3 @@
-import ssl
-import adafruit_requests
-import socketpool
-import wifi
 import time
 
 try:
@@ -9,6 +5,27 @@ try:
 except ImportError:
     pass
 
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    from io import IOBase
+except ImportError:
+    IOBase = object
+
+# Streaming decompression: zlib.decompressobj on CPython, deflate.DeflateIO or zlib.DecompIO on the device.
+# Without any of them, compressed transfers are not requested.
+CAN_INFLATE = deflate is not None or (zlib is not None and (hasattr(zlib, "decompressobj") or hasattr(zlib, "DecompIO")))
+GZIP_WBITS = 31
+ZLIB_WBITS = 15
+
 class User:
     email: str
     email_confirmed_at: str
@@ -85,7 +102,7 @@ CZMRJCQUzym+5iPDuI9yP+kHyCREU3qzuWFloUwOxkgAyXVjBYdwRVKD05WdRerw
 """
 
 class Supabase:
-    def __init__(self, url: str, public_key: str):
+    def __init__(self, url: str, public_key: str, session=None):
         self.url = url
         self.public_key = public_key
         self.headers = {
@@ -94,13 +111,23 @@ class Supabase:
         }
         self.access_token = None
 
+        # Any session with the adafruit_requests interface works, e.g. for running on CPython
+        self.requests = session if session is not None else self._create_session()
+
+    @staticmethod
+    def _create_session():
+        import ssl
+        import adafruit_requests
+        import socketpool
+        import wifi
+
         pool = socketpool.SocketPool(wifi.radio)
         context = ssl.create_default_context()
         # This is a workaround for the SSL issue (should be fixed with updated root.pem in newer versions of CircuitPython)
         print("Loading custom certificates")
         context.load_verify_locations(cadata=cadata)
 
-        self.requests = adafruit_requests.Session(pool, context)
+        return adafruit_requests.Session(pool, context)
 
     class Auth:
         def __init__(self, parent):
@@ -175,6 +202,48 @@ class Supabase:
                 print(f'HTTP error occurred: {err}')
                 raise Exception(f'Failed to fetch object: {err}')
         
+        def download_public_object(self, bucket_name: str, filename: str, file, params: Dict[str, Any] = None, chunk_size: int = 1024) -> int:
+            '''Stream an object into a writable file object, chunk by chunk, and return the number of bytes written.
+
+            Asks for gzip transfer encoding when the device can inflate it. Objects stored
+            compressed are recognized by their suffix, ".gz" for gzip and ".z" for zlib.
+            Compressed data is inflated on the fly, so the full image is never held in memory.
+            '''
+            url = f'{self.base_url}/object/public/{bucket_name}/{filename}'
+            if params:
+                    url += "?"
+                    for key, value in params.items():
+                        url += f"{key}={value}&"
+                    url = url[:-1]
+            headers = self.parent.headers.copy()
+            if CAN_INFLATE:
+                headers['Accept-Encoding'] = 'gzip'
+            try:
+                response = self.parent.requests.get(url, headers=headers, stream=True)
+                if response.status_code == 404:
+                    response.close()
+                    raise Exception(f'Object not found: {filename}')
+
+                wbits = None
+                if response.headers.get('content-encoding') == 'gzip' or filename.endswith('.gz'):
+                    wbits = GZIP_WBITS
+                elif is_compressed(filename):
+                    wbits = ZLIB_WBITS
+
+                try:
+                    if wbits is None:
+                        written = 0
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            file.write(chunk)
+                            written += len(chunk)
+                        return written
+                    return _inflate(response.iter_content(chunk_size=chunk_size), file, wbits, chunk_size)
+                finally:
+                    response.close()
+            except Exception as err:
+                print(f'HTTP error occurred: {err}')
+                raise Exception(f'Failed to fetch object: {err}')
+
         def get_object_info(self, bucket_name: str, wildcard: str):
             try:
                 response = self.parent.requests.get(
@@ -207,6 +276,32 @@ class Supabase:
                 print(f'HTTP error occurred: {err}')
                 raise Exception(f'Failed to fetch public object info: {err}')
     
+    class Database:
+        def __init__(self, parent):
+            self.parent = parent
+            self.base_url = f'{self.parent.url}/rest/v1'
+
+        def insert(self, table: str, rows: List[Dict[str, Any]], upsert: bool = False, on_conflict: str = None):
+            '''Insert one or more rows into a PostgREST table with a single request.'''
+            url = f'{self.base_url}/{table}'
+            if on_conflict:
+                url += f'?on_conflict={on_conflict}'
+            headers = self.parent.headers.copy()
+            # Nothing is read back, so don't make the server send the rows again
+            headers['Prefer'] = 'return=minimal,resolution=merge-duplicates' if upsert else 'return=minimal'
+            try:
+                response = self.parent.requests.post(url, headers=headers, json=rows)
+                status_code = response.status_code
+                response.close()
+            except Exception as err:
+                print(f'HTTP error occurred: {err}')
+                raise Exception(f'Failed to insert into {table}: {err}')
+            if status_code >= 300:
+                raise Exception(f'Failed to insert into {table}: HTTP {status_code}')
+
+        def upsert(self, table: str, rows: List[Dict[str, Any]], on_conflict: str = None):
+            return self.insert(table, rows, upsert=True, on_conflict=on_conflict)
+
     @property
     def auth(self):
         return self.Auth(self)
@@ -215,5 +310,65 @@ class Supabase:
     def storage(self):
         return self.Storage(self)
 
-def createClient(url: str, public_key: str) -> Supabase:
-        return Supabase(url, public_key)
\ No newline at end of file
+    @property
+    def database(self):
+        return self.Database(self)
+
+def is_compressed(filename: str) -> bool:
+    '''Whether an object is stored compressed, judging by its suffix.'''
+    return filename.endswith('.gz') or filename.endswith('.z')
+
+class _ChunkStream(IOBase):
+    '''Readable stream over an iterator of chunks, for the device's streaming decompressors.
+    The native DeflateIO and DecompIO wrappers only accept streams derived from io.IOBase.'''
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def read(self, size=-1):
+        buffer = bytearray(size if size > 0 else 1024)
+        return bytes(buffer[:self.readinto(buffer)])
+
+def _inflate(chunks, file, wbits: int, chunk_size: int) -> int:
+    '''Inflate an iterator of compressed chunks into file, at most chunk_size bytes at a time.'''
+    written = 0
+    if zlib is not None and hasattr(zlib, "decompressobj"):
+        decompressor = zlib.decompressobj(wbits)
+        for chunk in chunks:
+            while chunk:
+                data = decompressor.decompress(chunk, chunk_size)
+                file.write(data)
+                written += len(data)
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        file.write(data)
+        return written + len(data)
+
+    if deflate is not None:
+        stream = deflate.DeflateIO(_ChunkStream(chunks), deflate.GZIP if wbits == GZIP_WBITS else deflate.ZLIB)
+    elif zlib is not None and hasattr(zlib, "DecompIO"):
+        stream = zlib.DecompIO(_ChunkStream(chunks), wbits)
+    else:
+        raise Exception('Compressed objects are not supported on this device')
+
+    buffer = bytearray(chunk_size)
+    while True:
+        size = stream.readinto(buffer)
+        if not size:
+            return written
+        file.write(buffer[:size] if size < chunk_size else buffer)
+        written += size
+
+def createClient(url: str, public_key: str, session=None) -> Supabase:
+        return Supabase(url, public_key, session=session)
\ No newline at end of file
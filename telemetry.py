@@ -0,0 +1,159 @@
+import json
+import time
+import binascii
+import microcontroller
+from utils import is_readonly
+
+TELEMETRY_FILE_PATH = "/telemetry.json"
+MAX_EVENTS = 50
+# Seconds between writes of the queue to flash
+SAVE_INTERVAL = 600
+
+class Telemetry:
+    '''Queues device events (read receipts, poll errors, boot times) and uploads
+    them to a Supabase table in batches, piggybacked on the regular poll.
+
+    The queue is kept in a small JSON file so events survive a reboot, including
+    a crash or a watchdog reset. Urgent and new events are written right away,
+    repeats that only increment a count every save_interval seconds, when a flush
+    fails and before a restart. Once it holds max_events, the oldest events are dropped.
+    '''
+    def __init__(self, table: str, device_id: str = None, flush_interval: int = 300, max_events: int = MAX_EVENTS, save_interval: int = SAVE_INTERVAL, debug=False):
+        self._debug = debug
+        self.table = table
+        self.device_id = device_id or binascii.hexlify(microcontroller.cpu.uid).decode()
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.save_interval = save_interval
+
+        self.state = {"boot": 0, "events": []}
+        self._due = False
+        self._last_flush = time.monotonic()
+        self._last_save = time.monotonic()
+        self._dirty = False
+        # Poll statistics are only kept in memory and sent as one row per flush
+        self._polls = {"count": 0, "errors": 0, "total_duration": 0.0, "max_duration": 0.0}
+
+        if self.enabled:
+            self.load()
+            self.state["boot"] += 1
+            self._dirty = True
+            self.save()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.table)
+
+    @property
+    def events(self):
+        return self.state["events"]
+
+    def record(self, event: str, urgent: bool = False, **data):
+        '''Queue an event. Urgent events (read receipts) are sent with the next poll,
+        the rest wait for the flush interval. A repeat of the last event with the
+        same data only increments its count.'''
+        if not self.enabled:
+            return
+
+        repeat = self.events and self.events[-1]["event"] == event and self.events[-1]["data"] == data
+        if repeat:
+            self.events[-1]["count"] += 1
+        else:
+            self.events.append({
+                "event": event,
+                "data": data,
+                "count": 1,
+                "boot": self.state["boot"],
+                "uptime": round(time.monotonic(), 1),
+            })
+            if len(self.events) > self.max_events:
+                del self.events[: len(self.events) - self.max_events]
+
+        if urgent:
+            self._due = True
+        self._dirty = True
+        self._debug and print(f"Telemetry event: {event} {data}")
+        if urgent or not repeat:
+            self.save()
+
+    def record_poll(self, duration: float, failed: bool = False):
+        self._polls["count"] += 1
+        if failed:
+            self._polls["errors"] += 1
+        self._polls["total_duration"] += duration
+        self._polls["max_duration"] = max(self._polls["max_duration"], duration)
+
+    def flush_due(self) -> bool:
+        if not self.enabled:
+            return False
+        if self._due:
+            return True
+        if time.monotonic() - self._last_flush < self.flush_interval:
+            return False
+        return bool(self.events or self._polls["count"])
+
+    def flush(self, supabase) -> bool:
+        '''Upload all queued events in one request. On failure the queue is kept for the next attempt.'''
+        if not self.enabled:
+            return False
+
+        rows = []
+        for event in self.events:
+            row = {"device_id": self.device_id}
+            row.update(event)
+            rows.append(row)
+        if self._polls["count"]:
+            polls = self._polls.copy()
+            polls["total_duration"] = round(polls["total_duration"], 2)
+            polls["max_duration"] = round(polls["max_duration"], 2)
+            rows.append({
+                "device_id": self.device_id,
+                "event": "polls",
+                "data": polls,
+                "count": polls["count"],
+                "boot": self.state["boot"],
+                "uptime": round(time.monotonic(), 1),
+            })
+
+        self._last_flush = time.monotonic()
+        if not rows:
+            self._due = False
+            return True
+
+        try:
+            supabase.database.insert(self.table, rows)
+        except Exception as e:
+            print(f"Failed to upload telemetry: {e}")
+            self.save()
+            return False
+
+        self._debug and print(f"Uploaded {len(rows)} telemetry events.")
+        self.state["events"] = []
+        self._polls = {"count": 0, "errors": 0, "total_duration": 0.0, "max_duration": 0.0}
+        self._due = False
+        self._dirty = True
+        self.save()
+        return True
+
+    def load(self):
+        try:
+            with open(TELEMETRY_FILE_PATH, "r") as file:
+                self.state = json.load(file)
+        except:
+            self._debug and print("Telemetry queue not found / is corrupted. A new one will be created upon saving.")
+
+    def save_if_due(self):
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        '''Write the queue to flash, if it changed since the last write.'''
+        self._last_save = time.monotonic()
+        if not self._dirty or is_readonly():
+            return
+        try:
+            with open(TELEMETRY_FILE_PATH, "w") as file:
+                json.dump(self.state, file)
+            self._dirty = False
+        except Exception as e:
+            print(f"Failed to save the telemetry queue: {e}")
@@ -0,0 +1,413 @@
+"""Fleet-scale polling load simulator.
+
+Runs thousands of virtual boxes against a local stand-in for Supabase Storage and
+reports what the fleet costs the backend: request rate, egress bytes, notification
+latency and server CPU, for each combination of poll interval and fetch strategy.
+
+The boxes use the firmware's own supabase.py client and poller.py change detection,
+so changes to either show up here before they are rolled out. Runs on CPython 3.8+
+with the standard library only:
+
+    python tools/fleet_sim.py --boxes 2000 --intervals 8 30 60 --duration 120
+
+Fetch strategies:
+    info      the firmware's loop: an info request per poll, a download on change
+    download  download the object on every poll and compare content hashes
+
+With --gzip the stand-in honours the firmware's Accept-Encoding: gzip, like a CDN
+compressing responses would.
+"""
+import argparse
+import contextlib
+import gzip
+import hashlib
+import heapq
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from email.utils import formatdate
+from json import dumps as json_dumps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from supabase import createClient  # noqa: E402
+from poller import check_for_note, content_hash  # noqa: E402
+
+BUCKET = "notes"
+STRATEGIES = ("info", "download")
+
+
+# Stand-in server
+
+class StorageStandIn:
+    """The subset of the Supabase Storage API the box uses, with counters."""
+
+    def __init__(self, compress=False):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.compress = compress
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.egress_bytes = 0
+            self.cpu_start = time.process_time()
+            self.wall_start = time.monotonic()
+
+    def upload(self, path, data):
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        # Compressed once on upload, like a CDN caching the encoded response
+        compressed = gzip.compress(data) if self.compress else None
+        with self.lock:
+            self.objects[path] = (data, compressed, etag, formatdate(usegmt=True))
+        return {"etag": etag, "last-modified": self.objects[path][3], "hash": content_hash(data)}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "egress_bytes": self.egress_bytes,
+                "cpu_seconds": time.process_time() - self.cpu_start,
+                "wall_seconds": time.monotonic() - self.wall_start,
+            }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        info_prefix = "/storage/v1/object/info/public/%s/" % BUCKET
+        object_prefix = "/storage/v1/object/public/%s/" % BUCKET
+        if path == "/_stats":
+            self._send(200, json.dumps(self.store.stats()).encode(), count=False)
+        elif path.startswith(info_prefix):
+            self._send_object(path[len(info_prefix):], with_body=False)
+        elif path.startswith(object_prefix):
+            self._send_object(path[len(object_prefix):], with_body=True)
+        else:
+            self._send(404, b"{}")
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path == "/_reset":
+            self.store.reset()
+            self._send(200, b"{}", count=False)
+        elif path.startswith("/_upload/"):
+            result = self.store.upload(path[len("/_upload/"):], body)
+            self._send(200, json.dumps(result).encode(), count=False)
+        else:
+            self._send(404, b"{}")
+
+    def _send_object(self, name, with_body):
+        with self.store.lock:
+            entry = self.store.objects.get(name)
+        if entry is None:
+            self._send(404, b'{"error": "not_found"}')
+            return
+        data, compressed, etag, last_modified = entry
+        if with_body:
+            headers = {"etag": etag, "last-modified": last_modified, "content-type": "image/bmp"}
+            if compressed is not None and "gzip" in self.headers.get("Accept-Encoding", ""):
+                headers["content-encoding"] = "gzip"
+                data = compressed
+            self._send(200, data, headers)
+        else:
+            body = json.dumps({"name": name, "size": len(data)}).encode()
+            self._send(200, body, {"etag": etag, "last-modified": last_modified})
+
+    def _send(self, status, body, headers=None, count=True):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            # Approximate size of the status line and headers on the wire
+            header_bytes = 100 + sum(len(k) + len(v) + 4 for k, v in (headers or {}).items())
+            with self.store.lock:
+                self.store.requests += 1
+                self.store.egress_bytes += header_bytes + len(body)
+
+
+def serve(port, ready, compress):
+    StandInHandler.store = StorageStandIn(compress)
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+
+# Client side
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1024):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class HttpSession:
+    """Keep-alive HTTP session with the adafruit_requests interface supabase.py expects."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection = None
+
+    def request(self, method, url, headers=None, body=None):
+        parts = urlsplit(url)
+        target = parts.path + ("?" + parts.query if parts.query else "")
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, target, body=body, headers=headers or {})
+                response = self.connection.getresponse()
+                content = response.read()
+                # adafruit_requests lowercases header names
+                headers = {key.lower(): value for key, value in response.getheaders()}
+                return Response(response.status, headers, content)
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def get(self, url, headers=None, stream=False):
+        return self.request("GET", url, headers)
+
+    def post(self, url, headers=None, json=None, data=None):
+        body = data if json is None else json_dumps(json).encode()
+        return self.request("POST", url, headers, body)
+
+
+def poll_once(storage, strategy, path, state):
+    """One poll of one box. Returns the hash of a newly delivered note, or None."""
+    if strategy == "info":
+        return state["hash"] if check_for_note(storage, BUCKET, path, state) else None
+
+    image = io.BytesIO()
+    storage.download_public_object(BUCKET, path, image, params={"version": time.monotonic()})
+    digest = content_hash(image.getvalue())
+    if digest == state.get("hash"):
+        return None
+    state["hash"] = digest
+    return digest
+
+
+def run_boxes(job):
+    """Runs a slice of the fleet in one process, spread over a few threads."""
+    boxes = job["boxes"]
+    deliveries = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run_thread(thread_boxes):
+        session = HttpSession("127.0.0.1", job["port"])
+        client = createClient("http://127.0.0.1:%d" % job["port"], "anon-key", session=session)
+        storage = client.storage
+        rng = random.Random(thread_boxes[0][0] if thread_boxes else 0)
+        # Boxes boot at random times, so polls spread over the interval
+        queue = [(job["start"] + rng.uniform(0, job["interval"]), path, state) for path, state in thread_boxes]
+        heapq.heapify(queue)
+        while queue:
+            due, path, state = heapq.heappop(queue)
+            if due >= job["end"]:
+                break
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                digest = poll_once(storage, job["strategy"], path, state)
+                if digest is not None:
+                    with lock:
+                        deliveries.append((digest, time.time()))
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            # Like the firmware, the next poll is scheduled after this one finished
+            heapq.heappush(queue, (time.time() + job["interval"], path, state))
+
+    threads = []
+    per_thread = max(1, (len(boxes) + job["threads"] - 1) // job["threads"])
+    # The client and poller print progress, which would drown the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(0, len(boxes), per_thread):
+            thread = threading.Thread(target=run_thread, args=(boxes[i:i + per_thread],))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    return deliveries, errors[0]
+
+
+# Orchestration
+
+def control(port, method, path, body=b""):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    connection.request(method, path, body=body)
+    result = json.loads(connection.getresponse().read())
+    connection.close()
+    return result
+
+
+def random_note(rng, size):
+    """Something like a hand-drawn sketch: a flat background with a few random strokes."""
+    note = bytearray([rng.randrange(256)]) * size
+    note[0:2] = b"BM"
+    for _ in range(size // 512):
+        start = rng.randrange(2, size)
+        stroke = bytes(rng.randrange(256) for _ in range(rng.randrange(8, 64)))
+        note[start:start + len(stroke)] = stroke
+    return bytes(note[:size])
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_scenario(args, interval, strategy):
+    rng = random.Random(args.seed)
+    paths = ["box-%d.bmp" % i for i in range(args.boxes)]
+
+    # Every box starts in sync with its current note
+    boxes = []
+    for path in paths:
+        info = control(args.port, "POST", "/_upload/" + path, random_note(rng, args.image_size))
+        boxes.append((path, {"etag": info["etag"], "last-modified": info["last-modified"], "hash": info["hash"]}))
+
+    start = time.time() + 1
+    end = start + args.duration
+    per_process = (len(boxes) + args.processes - 1) // args.processes
+    jobs = [
+        {
+            "boxes": boxes[i:i + per_process],
+            "port": args.port,
+            "interval": interval,
+            "strategy": strategy,
+            "threads": args.threads,
+            "start": start,
+            "end": end,
+        }
+        for i in range(0, len(boxes), per_process)
+    ]
+
+    uploads = {}
+
+    def upload_notes():
+        # Senders upload new notes at random (Poisson) times, stopping early enough to be delivered
+        rate = args.boxes * args.notes_per_hour / 3600.0
+        next_upload = start + rng.expovariate(rate) if rate else end
+        while next_upload < end - interval * 2:
+            delay = next_upload - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            note = random_note(rng, args.image_size)
+            info = control(args.port, "POST", "/_upload/" + rng.choice(paths), note)
+            uploads[info["hash"]] = time.time()
+            next_upload += rng.expovariate(rate)
+
+    control(args.port, "POST", "/_reset")
+    uploader = threading.Thread(target=upload_notes)
+    uploader.start()
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.map(run_boxes, jobs)
+    uploader.join()
+    stats = control(args.port, "GET", "/_stats")
+
+    latencies = []
+    errors = 0
+    for deliveries, job_errors in results:
+        errors += job_errors
+        for digest, delivered_at in deliveries:
+            if digest in uploads:
+                latencies.append(delivered_at - uploads[digest])
+
+    return {
+        "interval": interval,
+        "strategy": strategy,
+        "requests_per_second": stats["requests"] / stats["wall_seconds"],
+        "egress_mb": stats["egress_bytes"] / 1e6,
+        "egress_mb_per_box_day": stats["egress_bytes"] / 1e6 / args.boxes * 86400 / stats["wall_seconds"],
+        "notes": len(uploads),
+        "delivered": len(latencies),
+        "p50_latency": percentile(latencies, 0.5),
+        "p99_latency": percentile(latencies, 0.99),
+        "server_cpu_percent": 100 * stats["cpu_seconds"] / stats["wall_seconds"],
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, default=1000, help="number of virtual boxes")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[8.0], help="poll intervals to compare, in seconds")
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=list(STRATEGIES))
+    parser.add_argument("--duration", type=float, default=120.0, help="seconds per scenario, several poll intervals long")
+    parser.add_argument("--notes-per-hour", type=float, default=6.0, help="new notes per box and hour")
+    parser.add_argument("--image-size", type=int, default=32 * 1024 + 138, help="note size in bytes")
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--threads", type=int, default=32, help="threads per process")
+    parser.add_argument("--gzip", action="store_true", help="serve gzip encoded objects to clients that accept them")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, ready, args.gzip), daemon=True)
+    server.start()
+    ready.wait()
+
+    results = []
+    try:
+        for strategy in args.strategies:
+            for interval in args.intervals:
+                print("Simulating %d boxes, %s strategy, %gs interval..." % (args.boxes, strategy, interval), file=sys.stderr)
+                results.append(run_scenario(args, interval, strategy))
+    finally:
+        server.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%-9s %8s %9s %10s %13s %11s %9s %9s %8s %7s" % (
+        "strategy", "interval", "req/s", "egress MB", "MB/box/day", "delivered", "p50 s", "p99 s", "cpu %", "errors"))
+    for r in results:
+        print("%-9s %8g %9.1f %10.1f %13.2f %5d/%-5d %9.2f %9.2f %8.1f %7d" % (
+            r["strategy"], r["interval"], r["requests_per_second"], r["egress_mb"], r["egress_mb_per_box_day"],
+            r["delivered"], r["notes"], r["p50_latency"], r["p99_latency"], r["server_cpu_percent"], r["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import time
 import storage
 
 def file_exists(file):
@@ -8,4 +9,28 @@ def file_exists(file):
         return False
 
 def is_readonly():
-    return storage.getmount("/").readonly
\ No newline at end of file
+    return storage.getmount("/").readonly
+
+class BootTimer:
+    '''Records how long each boot stage took, relative to the start of code.py.'''
+    def __init__(self, debug=True):
+        self._debug = debug
+        self._start = time.monotonic()
+        self.marks = []
+
+    def mark(self, stage: str) -> float:
+        elapsed = time.monotonic() - self._start
+        self.marks.append((stage, elapsed))
+        if self._debug:
+            print(f"[boot] {elapsed:.2f}s {stage}")
+        return elapsed
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def report(self):
+        print("Boot timing:")
+        previous = 0.0
+        for stage, elapsed in self.marks:
+            print(f"  {elapsed:6.2f}s (+{elapsed - previous:.2f}s) {stage}")
+            previous = elapsed
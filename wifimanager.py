@@ -1,29 +1,26 @@
 import wifi
 import json
-import socketpool
-import mdns
+import os
 import time
-from adafruit_httpserver import (
-    Server as HTTPServer,
-    Response as HTTPResponse,
-    Request as HTTPRequest,
-    MIMETypes,
-)
 from utils import is_readonly
-from adafruit_templateengine import render_template
-import adafruit_miniqr
 
-MIMETypes.configure(
-    default_to="text/plain",
-    # Unregistering unnecessary MIME types can save memory
-    keep_for=[".html", ".css", ".png", ".ico"],
-)
+# The portal dependencies (adafruit_httpserver, adafruit_templateengine,
+# adafruit_miniqr, mdns) are imported in start_server, so a box with a known
+# network never pays for loading them at boot.
 
 AP_SSID = os.getenv("AP_SSID")
 AP_PASSWORD = os.getenv("AP_PASSWORD")
 MDNS_HOSTNAME = os.getenv("AP_MDNS_HOSTNAME")
 CONFIG_FILE_PATH = "/wifi.json"
 
+# Portal timings, in seconds
+CONNECT_TIMEOUT = 10
+SCAN_CACHE_TIME = 30
+# Keeps the portal up after connecting, so the page can pick up the result
+HANDOFF_TIME = 5
+# Sleep between server polls while no request comes in
+IDLE_SLEEP = 0.05
+
 class WifiManager:
     def __init__(self, graphics, debug=False):
         self._debug = debug
@@ -35,7 +32,20 @@ class WifiManager:
         self.config = {"latest": None, "known_networks": {}}
         self.load_config()
 
-    def get_connection(self) -> bool:
+        self.graphics.add_screen("connected", [
+            {"text": "\uf1eb", "font": "fonts/forkawesome-12.pcf", "position": (self.graphics.display.width / 2, (self.graphics.display.height / 2) - 15), "scale": 3},
+            {"text": "Connected!", "font": "fonts/hang-the-dj-12.bdf", "position": (self.graphics.display.width / 2, self.graphics.display.height - 15)},
+        ])
+
+        # Portal connection attempt, run between server polls rather than inside a request
+        self.portal_status = {"state": "idle", "ssid": None}
+        self._pending_credentials = None
+        self._scan_cache = None
+        self._scan_time = 0
+
+    def get_connection(self, last_network=None) -> bool:
+        '''last_network is an optional (ssid, channel) pair remembered from a previous run.
+        When it matches the latest credentials, the channel saves the radio a full scan.'''
         if self.is_connected() is True:
             if self._debug:
                 print("Already connected.")
@@ -50,7 +60,13 @@ class WifiManager:
             
             ssid = self.config["latest"]["ssid"]
             password = self.config["latest"]["password"]
-            if self.connect(ssid, password):
+            channel = 0
+            if last_network is not None and last_network[0] == ssid:
+                channel = last_network[1] or 0
+            if self.connect(ssid, password, channel=channel):
+                return True
+            if channel and self.connect(ssid, password):
+                # The access point may have moved to another channel
                 return True
         
         if self._debug:
@@ -91,9 +107,9 @@ class WifiManager:
         
         return False
 
-    def connect(self, ssid: str, password: str) -> bool:
+    def connect(self, ssid: str, password: str, timeout=None, channel=0) -> bool:
         try:
-            wifi.radio.connect(ssid, password)
+            wifi.radio.connect(ssid, password, channel=channel, timeout=timeout)
             if self._debug:
                 print("Connected to: " + ssid)
             return True
@@ -104,6 +120,25 @@ class WifiManager:
             return False
 
     def start_server(self):
+        import mdns
+        import socketpool
+        import adafruit_miniqr
+        from adafruit_templateengine import render_template
+        from adafruit_httpserver import (
+            Server as HTTPServer,
+            Response as HTTPResponse,
+            Request as HTTPRequest,
+            JSONResponse,
+            MIMETypes,
+            NO_REQUEST,
+        )
+
+        MIMETypes.configure(
+            default_to="text/plain",
+            # Unregistering unnecessary MIME types can save memory
+            keep_for=[".html", ".css", ".png", ".ico"],
+        )
+
         if self._debug:
             print("Starting AP...")
         wifi.radio.start_ap(AP_SSID, AP_PASSWORD)
@@ -125,6 +160,7 @@ class WifiManager:
         )
         qr.make()
 
+        self.graphics.set_background(None)
         self.graphics.remove_all_text()
 
         self.graphics.add_text(
@@ -156,12 +192,7 @@ class WifiManager:
 
         @server.route("/")
         def route_func(request: HTTPRequest):
-            ssids = []
-            for network in wifi.radio.start_scanning_networks():
-                ssids.append(network.ssid)
-            wifi.radio.stop_scanning_networks()
-
-            context = { "ssids": ssids }
+            context = { "ssids": self.scan_ssids() }
             response = render_template("/templates/index.html", context)
 
             return HTTPResponse(request, content_type="text/html", body=response)
@@ -172,52 +203,45 @@ class WifiManager:
             password = request.form_data.get("password", "")
 
             if self._debug:
-                print("Connecting to: " + ssid)
-
-            if self.connect(ssid, password):
-                # Save the new network to the configuration
-                self.add_new_wifi_network(ssid, password)
-                
-                # TODO: Render a success page instead of this
-                return HTTPResponse(
-                    request,
-                    body="Connected!",
-                    content_type="text/plain",
-                )
-            else:
-                response = render_template("/templates/error.html")
-                return HTTPResponse(
-                    request,
-                    body=response,
-                    content_type="text/html",
-                )
+                print("Queueing connection to: " + ssid)
+
+            # The attempt itself runs in the poll loop, after this page is sent
+            self._pending_credentials = (ssid, password)
+            self.portal_status = {"state": "pending", "ssid": ssid}
+
+            response = render_template("/templates/connecting.html", { "ssid": ssid })
+            return HTTPResponse(request, content_type="text/html", body=response)
+
+        @server.route("/status")
+        def route_func(request: HTTPRequest):
+            return JSONResponse(request, self.portal_status)
+
+        @server.route("/error")
+        def route_func(request: HTTPRequest):
+            response = render_template("/templates/error.html")
+            return HTTPResponse(request, content_type="text/html", body=response)
 
         server.start(str(wifi.radio.ipv4_address_ap), 80)
 
+        connected_at = None
         while True:
-            if wifi.radio.ap_info is None:
-                server.poll()
-            else:
+            try:
+                result = server.poll()
+            except Exception as e:
+                # A misbehaving client must not take the portal down for everyone else
+                print(f"Portal request failed: {e}")
+                result = None
+
+            if self._pending_credentials is not None:
+                self._attempt_pending_connection()
+                if self.portal_status["state"] == "connected":
+                    connected_at = time.monotonic()
+
+            if connected_at is not None and time.monotonic() - connected_at >= HANDOFF_TIME:
                 if self._debug:
                     print("Connected. Stopping...")
-                
-                self.graphics.remove_all_text()
-                self.graphics.remove_all_qr()
-                self.graphics.add_text((self.graphics.display.width / 2, (self.graphics.display.height / 2) - 15),
-                "fonts/forkawesome-12.pcf",
-                0xFF00FF,
-                line_spacing=1,
-                text_scale=3,
-                text_anchor_point=(0.5, 0.5),
-                text="\uf1eb",
-                )
-                self.graphics.add_text(
-                (self.graphics.display.width / 2, self.graphics.display.height - 15),
-                "fonts/hang-the-dj-12.bdf",
-                0xFF00FF,
-                text_anchor_point=(0.5, 0.5),
-                text="Connected!",
-                )
+
+                self.graphics.show_screen("connected")
 
                 server.stop()
                 mdns_server.deinit()
@@ -231,6 +255,37 @@ class WifiManager:
 
                 return
 
+            if result == NO_REQUEST:
+                time.sleep(IDLE_SLEEP)
+
+    def _attempt_pending_connection(self):
+        ssid, password = self._pending_credentials
+        self._pending_credentials = None
+        self.portal_status = {"state": "connecting", "ssid": ssid}
+
+        if self._debug:
+            print("Connecting to: " + ssid)
+
+        # wifi.radio.connect blocks, so bound it; the page keeps polling /status meanwhile
+        if self.connect(ssid, password, timeout=CONNECT_TIMEOUT):
+            # Save the new network to the configuration
+            self.add_new_wifi_network(ssid, password)
+            self.portal_status = {"state": "connected", "ssid": ssid}
+        else:
+            self.portal_status = {"state": "failed", "ssid": ssid}
+
+    def scan_ssids(self):
+        # Scanning takes seconds, so repeated page loads reuse the last result
+        if self._scan_cache is None or time.monotonic() - self._scan_time > SCAN_CACHE_TIME:
+            ssids = []
+            for network in wifi.radio.start_scanning_networks():
+                if network.ssid and network.ssid not in ssids:
+                    ssids.append(network.ssid)
+            wifi.radio.stop_scanning_networks()
+            self._scan_cache = ssids
+            self._scan_time = time.monotonic()
+        return self._scan_cache
+
     def is_connected(self) -> bool:
         return False if wifi.radio.ap_info is None else True
 